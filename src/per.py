@@ -10,19 +10,21 @@
 
 import gym
 import math
+import os
 import random
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
-from collections import namedtuple, deque
+from collections import deque
 from itertools import count
-from PIL import Image
 from torch.optim import Adam
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-import torchvision.transforms as T
 import highway_env
 env = gym.make('highway-v0').unwrapped
 
@@ -36,69 +38,166 @@ plt.ion()
 # if gpu is to be used
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 USE_CUDA = torch.cuda.is_available()
+# the screen size never changes, so let cuDNN benchmark its kernels once
+torch.backends.cudnn.benchmark = True
+
+# Optional multi-GPU training: launch with torchrun --nproc_per_node=N per.py.
+# Each rank runs its own env and replay buffer, and DDP all-reduces the
+# gradients in optimize_model so every rank steps the same policy.
+distributed = int(os.environ.get('WORLD_SIZE', '1')) > 1
+if distributed:
+    dist.init_process_group('nccl' if USE_CUDA else 'gloo')
+    local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+    if USE_CUDA:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+
+# Flat-array segment trees used by PER for O(log n) prioritized sampling.
+# The nodes live in a numpy array of size 2*capacity: node i has children
+# 2*i and 2*i+1, and the leaf for replay slot j sits at index capacity + j.
+class SegmentTree(object):
+    def __init__(self, capacity, operation, neutral_element):
+        # round the capacity up to a power of two so every node has two children
+        tree_capacity = 1
+        while tree_capacity < capacity:
+            tree_capacity *= 2
+        self.capacity  = tree_capacity
+        self.operation = operation
+        self.tree      = np.full(2 * tree_capacity, neutral_element, dtype=np.float64)
+
+    def __setitem__(self, idx, val):
+        idx += self.capacity
+        self.tree[idx] = val
+        idx //= 2
+        while idx >= 1:
+            self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
+            idx //= 2
+
+    def __getitem__(self, idx):
+        return self.tree[self.capacity + idx]
+
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumSegmentTree, self).__init__(capacity, np.add, 0.0)
+
+    def sum(self):
+        return self.tree[1]
+
+    def find_prefixsum_idx(self, prefixsum):
+        """Find the highest leaf idx such that the priorities before it sum to <= prefixsum."""
+        idx = 1
+        while idx < self.capacity:
+            left = 2 * idx
+            if self.tree[left] > prefixsum:
+                idx = left
+            else:
+                prefixsum -= self.tree[left]
+                idx = left + 1
+        return idx - self.capacity
+
+    def find_prefixsum_idx_batch(self, prefixsums):
+        """Resolve a whole batch of prefix sums at once, one tree level per numpy op."""
+        idx = np.ones_like(prefixsums, dtype=np.int64)
+        while idx[0] < self.capacity:
+            left = 2 * idx
+            go_right = self.tree[left] <= prefixsums
+            prefixsums = np.where(go_right, prefixsums - self.tree[left], prefixsums)
+            idx = left + go_right
+        return idx - self.capacity
+
 
-#here we define our transition (state, action, reward, next_state, done)
-# It essentially maps (state, action) pairs
-# to their (next_state, reward) result, with the state being the
-# screen difference image as described later on.
-Transition = namedtuple('Transition',
-                        ('state', 'action', 'reward', 'next_state','done'))
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinSegmentTree, self).__init__(capacity, min, float('inf'))
+
+    def min(self):
+        return self.tree[1]
 
 
 # This class implements a simple memory buffer replay with priority on experiences
 # We use this technique to compute loss on batches with no correlated states, and with prioritized experiences
+# The transitions are stored as preallocated contiguous tensors living on the device
+# (one tensor per field instead of a list of namedtuples), so sampling a batch is a
+# single gather kernel instead of 32 small torch.cat calls.
 class PER(object):
-    def __init__(self, capacity, prob_alpha=0.6):
+    def __init__(self, capacity, state_shape, prob_alpha=0.6):
         self.prob_alpha = prob_alpha
         self.capacity   = capacity
-        self.memory     = []
         self.pos        = 0
-        self.priorities = np.zeros((capacity,), dtype=np.float64)
-    
-    def push(self, *args):
-        max_prio = self.priorities.max() if self.memory else 1.0
-        
-        if len(self.memory) < self.capacity:
-            self.memory.append(Transition(*args))
-        else:
-            self.memory[self.pos] = Transition(*args)
-        
-        self.priorities[self.pos] = max_prio
-        self.pos = (self.pos + 1) % self.capacity
-    
+        self.size       = 0
+        # the trees store priorities already raised to prob_alpha, so sampling
+        # and importance weights never touch more than O(log n) entries
+        self.sum_tree   = SumSegmentTree(capacity)
+        self.min_tree   = MinSegmentTree(capacity)
+        self._max_prio  = 1.0
+        # one contiguous buffer per transition field, indexed by self.pos
+        self.states      = torch.empty((capacity,) + tuple(state_shape), device=device) \
+                                .contiguous(memory_format=torch.channels_last)
+        self.next_states = torch.empty((capacity,) + tuple(state_shape), device=device) \
+                                .contiguous(memory_format=torch.channels_last)
+        self.actions     = torch.empty((capacity, 1), dtype=torch.long, device=device)
+        self.rewards     = torch.empty((capacity,), device=device)
+        self.dones       = torch.empty((capacity,), dtype=torch.bool, device=device)
+        # staging buffer reused by sample, so the non-final next-state gather
+        # never allocates a fresh batch tensor
+        self._next_state_batch = torch.empty((BATCH_SIZE,) + tuple(state_shape), device=device)
+
+    def push(self, state, action, reward, next_state, done):
+        # new entries get the max priority seen so far, so they are sampled at least once
+        max_prio = self._max_prio
+
+        self.states[self.pos].copy_(state[0], non_blocking=True)
+        if next_state is not None:
+            self.next_states[self.pos].copy_(next_state[0], non_blocking=True)
+        self.actions[self.pos] = action
+        self.rewards[self.pos] = reward
+        self.dones[self.pos]   = done
+
+        self.sum_tree[self.pos] = max_prio
+        self.min_tree[self.pos] = max_prio
+        self.pos  = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
     def sample(self, beta=0.4):
         """Sample batch_size of experiences that have more priority."""
-        if len(self.memory) == self.capacity:
-            prios = self.priorities
-        else:
-            prios = self.priorities[:self.pos]
-        
-        probs  = prios ** self.prob_alpha
-        probs /= probs.sum()
-        
-        indices = np.random.choice(len(self.memory), BATCH_SIZE, p=probs)
-        total    = len(self.memory)
-        weights  = (total * probs[indices]) ** (-beta)
-        weights /= weights.max()
-        weights  = np.array(weights, dtype=np.float32)
-        
-        transitions = [self.memory[idx] for idx in indices]
-        batch       = Transition(*zip(*transitions))
-        states      = torch.cat(batch.state)
-        actions     = torch.cat(batch.action)
-        rewards     = torch.cat(batch.reward)
-        next_states = batch.next_state
-        dones       = batch.done
-        
-        return states, actions, rewards, next_states, dones, indices, weights
-    
+        total   = self.sum_tree.sum()
+        indices = self.sum_tree.find_prefixsum_idx_batch(np.random.random(BATCH_SIZE) * total)
+
+        probs = self.sum_tree.tree[self.sum_tree.capacity + indices] / total
+        # normalize by the largest possible weight, found in O(1) through the min tree
+        p_min      = self.min_tree.min() / total
+        max_weight = (self.size * p_min) ** (-beta)
+        weights    = (self.size * probs) ** (-beta) / max_weight
+        weights    = np.array(weights, dtype=np.float32)
+
+        idx_gpu     = torch.as_tensor(indices, dtype=torch.long, device=device)
+        states      = self.states.index_select(0, idx_gpu)
+        actions     = self.actions.index_select(0, idx_gpu)
+        rewards     = self.rewards.index_select(0, idx_gpu)
+
+        # build the non-final mask and the stacked non-final next states here,
+        # so the optimizer gets ready-to-use batch tensors
+        non_final_mask        = ~self.dones.index_select(0, idx_gpu)
+        non_final_idx         = idx_gpu[non_final_mask]
+        non_final_next_states = self._next_state_batch[:non_final_idx.numel()]
+        torch.index_select(self.next_states, 0, non_final_idx, out=non_final_next_states)
+
+        return states, actions, rewards, non_final_next_states, non_final_mask, indices, weights
+
     def update_priorities(self, batch_indices, batch_priorities):
         """Update the priorities every time we calculate a new loss"""
-        for idx, prio in zip(batch_indices, batch_priorities):
-            self.priorities[idx] = prio[0]
+        # raise the whole batch to prob_alpha in one vectorized numpy call,
+        # then propagate each leaf through its O(log n) tree path
+        new_prios = np.asarray(batch_priorities).reshape(-1) ** self.prob_alpha
+        for idx, new_prio in zip(batch_indices, new_prios):
+            self.sum_tree[idx] = new_prio
+            self.min_tree[idx] = new_prio
+        # keep the running max up to date so push never has to scan the buffer
+        self._max_prio = max(self._max_prio, new_prios.max())
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
 beta_start = 0.4
 beta_frames = 1000 
@@ -129,27 +228,62 @@ class DQN(nn.Module):
         self.head = nn.Linear(linear_input_size, outputs)
 
     def forward(self, x):
-        x = x.to(device)
+        x = x.to(device, memory_format=torch.channels_last)
         x = F.relu(self.bn1(self.conv1(x)))
         x = F.relu(self.bn2(self.conv2(x)))
         x = F.relu(self.bn3(self.conv3(x)))
-        return self.head(x.view(x.size(0), -1))
+        # flatten instead of view: the activations carry NHWC strides here,
+        # which view cannot express without a copy
+        return self.head(torch.flatten(x, 1))
 
 
 
 # Input extraction
 # ----------------
-resize = T.Compose([T.ToPILImage(),
-                    T.Resize(100, interpolation=T.InterpolationMode.BICUBIC),
-                    T.ToTensor()])
+# Frame uploads go through a side stream, so the copy engine moves the screen
+# to the device while the training kernels of the previous step are still
+# running on the default stream.
+copy_stream = torch.cuda.Stream() if USE_CUDA else None
+# pinned (page-locked) staging buffer: non_blocking uploads from pageable
+# numpy memory fall back to synchronous copies, pinned memory makes them
+# true async DMA transfers
+screen_buf = None
+# marks the end of the last upload out of screen_buf, so the CPU never
+# overwrites the buffer while the DMA engine may still be reading it
+upload_done = torch.cuda.Event() if USE_CUDA else None
 
 
 def get_screen():
     # Returned screen requested by gym is 600x150x3
-    screen = env.render(mode='rgb_array').transpose((2, 0, 1))
-    screen = np.ascontiguousarray(screen, dtype=np.float32) / 255
-    screen = torch.from_numpy(screen)
-    return resize(screen).unsqueeze(0)
+    # The frame is moved to the device as uint8 and resized there, so the
+    # whole CPU-side PIL resize pipeline goes away.
+    global screen_buf
+    screen = env.render(mode='rgb_array')
+    host = torch.from_numpy(np.ascontiguousarray(screen))
+    if USE_CUDA:
+        if screen_buf is None or screen_buf.shape != host.shape:
+            screen_buf = torch.empty_like(host, pin_memory=True)
+        else:
+            # wait_stream below only orders GPU streams, not the host, so the
+            # CPU-side refill has to block on the previous upload explicitly
+            upload_done.synchronize()
+        screen_buf.copy_(host)
+        host = screen_buf
+    if copy_stream is not None:
+        with torch.cuda.stream(copy_stream):
+            t = host.to(device, non_blocking=True)
+        upload_done.record(copy_stream)
+        # the default stream only waits on the copy, not the other way around
+        torch.cuda.current_stream().wait_stream(copy_stream)
+    else:
+        t = host.to(device)
+    t = t.permute(2, 0, 1).unsqueeze(0).float().mul_(1 / 255.)
+    # scale the smaller edge to 100, matching the old T.Resize(100)
+    h, w = t.shape[-2:]
+    scale = 100 / min(h, w)
+    t = F.interpolate(t, size=(round(h * scale), round(w * scale)),
+                      mode='bicubic', align_corners=False)
+    return t.contiguous(memory_format=torch.channels_last)
 
 
 env.reset()
@@ -179,19 +313,42 @@ n_actions = env.action_space.n
 
 # initialize our two networks
 # ---------------------------
-policy_net = DQN(screen_height, screen_width, n_actions).to(device)
-target_net = DQN(screen_height, screen_width, n_actions).to(device)
+# channels_last (NHWC) weights let cuDNN pick its TensorCore-friendly kernels
+policy_net = DQN(screen_height, screen_width, n_actions).to(device, memory_format=torch.channels_last)
+target_net = DQN(screen_height, screen_width, n_actions).to(device, memory_format=torch.channels_last)
 target_net.load_state_dict(policy_net.state_dict())
 target_net.eval()
 
+# compile the forward graphs when available; only the bound callables are
+# wrapped, so state dicts and checkpoints keep plain DQN keys
+if hasattr(torch, 'compile'):
+    policy_net.forward = torch.compile(policy_net.forward)
+    target_net.forward = torch.compile(target_net.forward)
+
+if distributed:
+    policy_net = DDP(policy_net, device_ids=[local_rank] if USE_CUDA else None)
+
+
+# unwrap DDP so target_net syncs and checkpoints keep plain DQN keys
+def policy_state_dict():
+    return policy_net.module.state_dict() if distributed else policy_net.state_dict()
+
+
 optimizer = Adam(policy_net.parameters(),lr = learning_rate)
+scaler = torch.cuda.amp.GradScaler(enabled=USE_CUDA)
 replay_initial = 10000
-per_memory = PER(10000)
+per_memory = PER(10000, init_screen.shape[1:])
 
 steps_done = 0
 
-# chose an action with epsilon-greedy 
+# chose an action with epsilon-greedy
 # -----------------------------------
+# one cached GPU tensor per action, so the explore branch neither runs the
+# network nor allocates a fresh device tensor every step
+action_tensors = [torch.tensor([[a]], device=device, dtype=torch.long)
+                  for a in range(n_actions)]
+
+
 def select_action(state):
     global steps_done
     sample = random.random()
@@ -199,28 +356,45 @@ def select_action(state):
         math.exp(-1. * steps_done / EPS_DECAY)
     steps_done += 1
     if sample > eps_threshold:
-        with torch.no_grad():
-            return policy_net(state).max(1)[1].view(1, 1)
+        # run the batch-1 forward in eval mode: train-mode BatchNorm would
+        # normalize with the single sample's own statistics and pollute the
+        # running averages on every greedy selection
+        was_training = policy_net.training
+        policy_net.eval()
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=USE_CUDA):
+            action = policy_net(state).max(1)[1].view(1, 1)
+        if was_training:
+            policy_net.train()
+        return action
     else:
-        return torch.tensor([[random.randrange(n_actions)]], device=device, dtype=torch.long)
+        return action_tensors[random.randrange(n_actions)]
 
 
 episode_durations = []
+episode_means = []
+# sliding window for the 100-episode average, maintained incrementally
+duration_window = deque(maxlen=100)
+window_sum = 0.0
 
 
 def plot_durations():
+    global window_sum
     plt.figure(2)
     plt.clf()
-    durations_t = torch.tensor(episode_durations, dtype=torch.float)
     plt.title('Training...')
     plt.xlabel('Episode')
     plt.ylabel('Duration')
-    plt.plot(durations_t.numpy())
-    # Take 100 episode averages and plot them too
-    if len(durations_t) >= 100:
-        means = durations_t.unfold(0, 100, 1).mean(1).view(-1)
-        means = torch.cat((torch.zeros(99), means))
-        plt.plot(means.numpy())
+    plt.plot(episode_durations)
+    # Take 100 episode averages and plot them too; the window sum is updated
+    # in O(1) per episode instead of unfolding the whole history every call
+    if len(duration_window) == duration_window.maxlen:
+        window_sum -= duration_window[0]
+    duration_window.append(episode_durations[-1])
+    window_sum += episode_durations[-1]
+    if len(duration_window) == duration_window.maxlen:
+        episode_means.append(window_sum / duration_window.maxlen)
+    if episode_means:
+        plt.plot(range(99, 99 + len(episode_means)), episode_means)
 
     plt.pause(0.001)  # pause a bit so that plots are updated
     if is_ipython:
@@ -228,101 +402,234 @@ def plot_durations():
         display.display(plt.gcf())
 
 
+# weighted TD error, kept as a standalone function so torch.compile can fuse
+# the elementwise chain into a single kernel
+def td_loss(q_value, next_q_values, reward, weights):
+    expected_q_value = (next_q_values * GAMMA) + reward
+    return (q_value - expected_q_value.unsqueeze(1)).pow(2) * weights
+
+
+if hasattr(torch, 'compile'):
+    td_loss = torch.compile(td_loss)
+
+
 # function to compute the loss and optimize the model weights/bias
 # ----------------------------------------------------------------
 def optimize_model(beta):
     if len(per_memory) < BATCH_SIZE:
         return
-    state, action, reward, next_state, done, indices, weights = per_memory.sample(beta) 
-
-    # Compute a mask of non-final states and concatenate the batch elements
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                          next_state)), device=device, dtype=torch.bool)
-    non_final_next_states = torch.cat([s for s in next_state
-                                                if s is not None])
-
-    q_values      = policy_net(state)
-    # Compute the Q values
-    q_value          = q_values.gather(1, action)
-    next_q_values = torch.zeros(BATCH_SIZE, device=device)
-    with torch.no_grad():
-        next_q_values[non_final_mask] = target_net(non_final_next_states).max(1)[0].detach()
-    # Compute the expected Q values
-    expected_q_value = (next_q_values * GAMMA) + reward
-    # Compute the loss and priorities
-    loss  = (q_value - expected_q_value.unsqueeze(1)).pow(2)*torch.as_tensor(weights)
-    prios = loss.detach() + 1e-5
-    loss  = loss.mean()
+    state, action, reward, non_final_next_states, non_final_mask, indices, weights = per_memory.sample(beta)
+
+    # run forward and loss in mixed precision; the scaler keeps fp16 gradients stable
+    with torch.cuda.amp.autocast(enabled=USE_CUDA):
+        q_values      = policy_net(state)
+        # Compute the Q values
+        q_value          = q_values.gather(1, action)
+        next_q_values = torch.zeros(BATCH_SIZE, device=device)
+        with torch.no_grad():
+            next_q_values[non_final_mask] = target_net(non_final_next_states).max(1)[0].detach()
+        # Compute the expected Q values, the loss and the priorities; the
+        # weights are unsqueezed to (B,1) so the multiply lines up with the
+        # per-sample TD errors instead of broadcasting to (B,B)
+        loss  = td_loss(q_value, next_q_values, reward,
+                        torch.as_tensor(weights, device=device).unsqueeze(1))
+        prios = loss.detach() + 1e-5
+        loss  = loss.mean()
 
     # Optimize the model
     optimizer.zero_grad()
-    loss.backward()
-    
+    scaler.scale(loss).backward()
+
     #update priorities
-    per_memory.update_priorities(indices, prios.data.cpu().numpy())
-    optimizer.step()
+    per_memory.update_priorities(indices, prios.squeeze(-1).cpu().numpy())
+    scaler.step(optimizer)
+    scaler.update()
     return loss
 
 
 # Training loop
 # -------------
+# Collective stop test for DDP runs: a rank that has finished its episodes
+# keeps stepping until every rank is done, so all ranks issue the same number
+# of gradient all-reduces and nobody is left blocked inside backward.
+def all_ranks_done(local_done):
+    if not distributed:
+        return local_done
+    flag = torch.tensor(float(local_done), device=device)
+    dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+    return bool(flag.item())
+
+
 def modele():
     num_episodes = 400
     total_reward = 0
-    for i_episode in range(num_episodes):
-        # Initialize the environment and state
-        env.reset()
-        last_screen = get_screen()
+    i_episode = 0
+    t = 0
+    # Initialize the environment and state; render once and start from a
+    # zero difference image, the two captures at reset would be identical
+    env.reset()
+    current_screen = get_screen()
+    state = torch.zeros_like(current_screen)
+    # The loop is flat over env steps with a collective stop test, so under
+    # DDP every rank runs the same number of iterations and therefore the
+    # same number of optimize_model backwards: episode lengths differ per
+    # rank, and a rank leaving early would strand the others in their
+    # gradient all-reduce.
+    while not all_ranks_done(i_episode >= num_episodes):
+        # Select and perform an action
+        action = select_action(state)
+        _, reward, done, _ = env.step(action.item())
+        total_reward += reward
+        t += 1
+        # Observe new state
+        last_screen = current_screen
         current_screen = get_screen()
-        state = current_screen - last_screen    
-        for t in count():
-            # Select and perform an action
-            action = select_action(state)
-            _, reward, done, _ = env.step(action.item())
-            total_reward += reward
-            reward = torch.tensor([reward], device=device)
-            # Observe new state
-            last_screen = current_screen
-            current_screen = get_screen()
-            if not done:
-                next_state = current_screen - last_screen
-            else:
-                next_state = None
+        if not done:
+            next_state = current_screen - last_screen
+        else:
+            next_state = None
 
-            # Store the transition in per_memory
-            per_memory.push(state, action, reward, next_state, done)
+        # Store the transition in per_memory; the raw float reward is written
+        # straight into the GPU-resident reward buffer, no per-step tensor needed
+        per_memory.push(state, action, reward, next_state, done)
 
-            # Move to the next state
-            state = next_state
+        # Move to the next state
+        state = next_state
 
-            # Perform one step of the optimization (on the policy network)
+        # Perform one step of the optimization (on the policy network)
+        # once the buffer holds enough transitions to decorrelate batches
+        if len(per_memory) >= replay_initial:
             beta = beta_by_frame(steps_done)
             optimize_model(beta)
-            if done:
-                episode_durations.append(t + 1)
-                plot_durations()
-                break
-                
-        if i_episode % 20 == 0:
-            print(f"Mean episode {i_episode}/400 reward is:{total_reward / 20:.2f}")
-            total_reward = 0
-        # Update the target network, copying all weights and biases in DQN
-        if i_episode % TARGET_UPDATE == 0:
-            target_net.load_state_dict(policy_net.state_dict())
+        if done:
+            episode_durations.append(t)
+            plot_durations()
+            i_episode += 1
+            t = 0
+            if i_episode % 20 == 0:
+                print(f"Mean episode {i_episode}/{num_episodes} reward is:{total_reward / 20:.2f}")
+                total_reward = 0
+            # Update the target network, copying all weights and biases in DQN
+            if i_episode % TARGET_UPDATE == 0:
+                target_net.load_state_dict(policy_state_dict())
+            # start the next episode from a fresh zero difference image
+            env.reset()
+            current_screen = get_screen()
+            state = torch.zeros_like(current_screen)
         
 
 
+# Vectorized training loop
+# ------------------------
+# N async worker processes step their own copy of highway-v0 in parallel,
+# so the CPU-bound env.step/env.render no longer serializes with training.
+# Screens come back through envs.call and are preprocessed as one batch.
+def make_env():
+    return lambda: gym.make('highway-v0')
+
+
+def get_screens_vec(envs):
+    frames = envs.call('render', mode='rgb_array')
+    t = torch.from_numpy(np.ascontiguousarray(np.stack(frames))).to(device, non_blocking=True)
+    t = t.permute(0, 3, 1, 2).float().mul_(1 / 255.)
+    h, w = t.shape[-2:]
+    scale = 100 / min(h, w)
+    t = F.interpolate(t, size=(round(h * scale), round(w * scale)),
+                      mode='bicubic', align_corners=False)
+    return t.contiguous(memory_format=torch.channels_last)
+
+
+# batched epsilon-greedy: one forward pass covers every worker env
+def select_actions_vec(states):
+    global steps_done
+    eps_threshold = EPS_END + (EPS_START - EPS_END) * \
+        math.exp(-1. * steps_done / EPS_DECAY)
+    steps_done += states.shape[0]
+    # eval mode for the same reason as select_action: rollout forwards must
+    # not update the BatchNorm running statistics
+    was_training = policy_net.training
+    policy_net.eval()
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=USE_CUDA):
+        greedy = policy_net(states).max(1)[1]
+    if was_training:
+        policy_net.train()
+    explore = torch.rand(states.shape[0], device=device) < eps_threshold
+    return torch.where(explore,
+                       torch.randint(n_actions, (states.shape[0],), device=device),
+                       greedy)
+
+
+def modele_vec(num_envs=4, num_episodes=400):
+    envs = gym.vector.AsyncVectorEnv([make_env() for _ in range(num_envs)])
+    envs.reset()
+    current_screens = get_screens_vec(envs)
+    states = torch.zeros_like(current_screens)
+    step_counts = np.zeros(num_envs, dtype=np.int64)
+    episodes_done = 0
+    total_reward = 0
+    # same collective stop test as modele: keeps the DDP all-reduce counts
+    # identical across ranks
+    while not all_ranks_done(episodes_done >= num_episodes):
+        actions = select_actions_vec(states)
+        _, rewards, dones, _ = envs.step(actions.cpu().numpy())
+        total_reward += rewards.sum()
+        step_counts += 1
+
+        # Observe the new states (done envs are auto-reset by the vector env)
+        last_screens = current_screens
+        current_screens = get_screens_vec(envs)
+        next_states = current_screens - last_screens
+        # a done env's new frame belongs to the next episode, so its state
+        # restarts from the zero difference image like the single-env loop
+        next_states[torch.as_tensor(dones, device=device)] = 0
+
+        for i in range(num_envs):
+            per_memory.push(states[i:i + 1], actions[i].view(1, 1), float(rewards[i]),
+                            None if dones[i] else next_states[i:i + 1], bool(dones[i]))
+            if dones[i]:
+                episodes_done += 1
+                episode_durations.append(int(step_counts[i]))
+                step_counts[i] = 0
+                plot_durations()
+                if episodes_done % 20 == 0:
+                    print(f"Mean episode {episodes_done}/{num_episodes} reward is:{total_reward / 20:.2f}")
+                    total_reward = 0
+                if episodes_done % TARGET_UPDATE == 0:
+                    target_net.load_state_dict(policy_state_dict())
+        states = next_states
+
+        # Perform one step of the optimization (on the policy network)
+        if len(per_memory) >= replay_initial:
+            beta = beta_by_frame(steps_done)
+            optimize_model(beta)
+    envs.close()
+
+
 # Train the model and save it
 # ---------------------------
 
 # modele()
 # torch.save(policy_net.state_dict(), "../models/model_per_400")
 
+# Fold each BatchNorm into its preceding conv for inference.
+# In eval mode BN is an affine transform, so it can be absorbed into the conv
+# weights: one kernel per layer instead of two, with identical outputs.
+def fuse_conv_bn(net):
+    fused = DQN(screen_height, screen_width, n_actions).to(device, memory_format=torch.channels_last)
+    fused.load_state_dict(net.state_dict())
+    fused.eval()
+    for conv_name, bn_name in (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')):
+        conv = getattr(fused, conv_name)
+        bn   = getattr(fused, bn_name)
+        setattr(fused, conv_name, fuse_conv_bn_eval(conv, bn))
+        setattr(fused, bn_name, nn.Identity())
+    return fused
+
+
 def run_episode(env, render = False):
     env.reset()
-    last_screen = get_screen()
     current_screen = get_screen()
-    state = current_screen - last_screen
+    state = torch.zeros_like(current_screen)
     total_reward = 0
     for t in count():
         if render:
@@ -350,7 +657,10 @@ def run_episode(env, render = False):
 
 # In case the modele is already trained we simply load it
 steps_done = 1000000000000
+if distributed:
+    policy_net = policy_net.module
 policy_net.load_state_dict(torch.load("../models/model_per_400"))
+policy_net = fuse_conv_bn(policy_net)
 policy_scores = [run_episode(env,True) for _ in range(50)]
 print("Average score of the policy: ", np.mean(policy_scores))
 env.close()